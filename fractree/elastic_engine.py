@@ -2,12 +2,140 @@
 """
 Fractal Elasticsearch Engine Module
 
-This module provides a class for interfacing with Elasticsearch using a fractal
+This module provides classes for interfacing with Elasticsearch using a fractal
 indexing approach. Documents are indexed with a cluster identifier to simulate
-fractal grouping.
+fractal grouping. A buffered indexer batches single-document writes into bulk
+requests.
 """
 
-from elasticsearch import Elasticsearch, helpers
+import atexit
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import BadRequestError, Elasticsearch
+from elasticsearch.serializer import OrjsonSerializer
+
+logger = logging.getLogger(__name__)
+
+# Encodes bulk request lines.
+_SERIALIZER = OrjsonSerializer()
+
+# (host, port, index_name) of indices known to exist, so that engines created
+# later in the same process skip the index creation round-trip.
+_KNOWN_INDICES = set()
+
+INDEX_MAPPING = {
+    "mappings": {
+        "properties": {
+            "doc_id": {"type": "keyword"},
+            "text": {"type": "text"},
+            "cluster": {"type": "keyword"}
+        }
+    }
+}
+
+
+def _client_kwargs(connections_per_node=10):
+    """
+    Build the keyword arguments for the Elasticsearch client.
+
+    Request bodies are gzip compressed, trading client CPU for fewer bytes
+    on the wire, which pays off for the text-heavy bulk requests. orjson
+    replaces the stdlib json module for encoding request bodies and
+    decoding responses.
+
+    Parameters:
+        connections_per_node (int): Size of the connection pool per node.
+    """
+    return {
+        'http_compress': True,
+        'connections_per_node': connections_per_node,
+        'retry_on_timeout': True,
+        'serializer': OrjsonSerializer(),
+    }
+
+
+def _is_index_exists_error(err):
+    """
+    Return whether a BadRequestError reports an already existing index.
+    """
+    return err.error == 'resource_already_exists_exception'
+
+
+def _bulk_bodies(docs, chunk_size, max_chunk_bytes):
+    """
+    Yield NDJSON bulk request bodies for the given documents.
+
+    Each document is encoded once, as an index action line followed by its
+    source line, into a rolling buffer. A body is emitted whenever the buffer
+    holds chunk_size documents or the next document would push it past
+    max_chunk_bytes.
+    """
+    buf = bytearray()
+    count = 0
+    for doc in docs:
+        lines = b"".join((
+            _SERIALIZER.dumps({"index": {"_id": doc['doc_id']}}), b"\n",
+            _SERIALIZER.dumps(doc), b"\n",
+        ))
+        if count and (count >= chunk_size
+                      or len(buf) + len(lines) > max_chunk_bytes):
+            yield bytes(buf)
+            buf.clear()
+            count = 0
+        buf += lines
+        count += 1
+    if buf:
+        yield bytes(buf)
+
+
+def _bulk_results(response):
+    """
+    Count the indexed and failed items of a bulk response, logging each
+    failure.
+
+    Returns:
+        tuple: Number of indexed documents and number of failed documents.
+    """
+    items = response['items']
+    if not response.get('errors'):
+        return len(items), 0
+    failed = 0
+    for item in items:
+        if 'error' in item.get('index', {}):
+            logger.error("Failed to index document: %s", item)
+            failed += 1
+    return len(items) - failed, failed
+
+
+# Search bodies pre-rendered for each filter arity. Only the JSON-encoded
+# query string and cluster label are spliced in per call.
+_SEARCH_TEMPLATE = b'{"query":{"bool":{"must":{"match":{"text":%s}}}}}'
+_FILTERED_SEARCH_TEMPLATE = (
+    b'{"query":{"bool":{"must":{"match":{"text":%s}},'
+    b'"filter":{"term":{"cluster":%s}}}}}'
+)
+
+
+def _query_body(query, cluster_filter=None):
+    """
+    Render the encoded search body for a query, optionally filtered by
+    cluster.
+    """
+    # The client serializers pass strings through as pre-encoded bodies, so
+    # the values are JSON-encoded here instead.
+    if cluster_filter:
+        return _FILTERED_SEARCH_TEMPLATE % (
+            json.dumps(query).encode(), json.dumps(cluster_filter).encode()
+        )
+    return _SEARCH_TEMPLATE % (json.dumps(query).encode(),)
 
 
 class FractalElasticsearchEngine:
@@ -15,7 +143,11 @@ class FractalElasticsearchEngine:
     Fractal Elasticsearch Engine for indexing documents and performing searches.
     """
 
-    def __init__(self, index_name='fractal_search', host='localhost', port=9200):
+    def __init__(self, index_name='fractal_search', host='localhost', port=9200,
+                 thread_count=None, chunk_size=500,
+                 max_chunk_bytes=10 * 1024 * 1024,
+                 search_cache_size=4096, search_cache_ttl=60,
+                 refresh_interval=1.0):
         """
         Initialize the Elasticsearch client and create the index.
 
@@ -23,27 +155,56 @@ class FractalElasticsearchEngine:
             index_name (str): The name of the Elasticsearch index.
             host (str): Elasticsearch host.
             port (int): Elasticsearch port.
+            thread_count (int): Number of threads used for bulk indexing.
+                                Defaults to the number of CPUs.
+            chunk_size (int): Number of documents sent per bulk request.
+            max_chunk_bytes (int): Maximum size in bytes of a bulk request.
+            search_cache_size (int): Number of search responses kept in the
+                                     LRU cache. 0 disables caching.
+            search_cache_ttl (float): Seconds after which cached search
+                                      responses expire. 0 or None disables
+                                      expiry.
+            refresh_interval (float): Seconds Elasticsearch takes to make
+                                      written documents searchable (the
+                                      index refresh interval). Searches are
+                                      not cached for this long after a write.
         """
         self.index_name = index_name
+        self._index_key = (host, port, index_name)
+        self.thread_count = thread_count or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.search_cache_ttl = search_cache_ttl
+        self.refresh_interval = refresh_interval
+        # Bumped on every write so that cached responses are not reused.
+        self._version = 0
+        self._last_write = None
+        # Writes come from request threads and the BufferedIndexer thread.
+        self._write_lock = threading.Lock()
+        self._cached_search = functools.lru_cache(
+            maxsize=search_cache_size
+        )(self._search)
         # Include the scheme parameter to resolve the missing argument error.
-        self.es = Elasticsearch([{'host': host, 'port': port, 'scheme': 'http'}])
+        # Keep a pooled connection per bulk thread so they never wait on
+        # each other for a socket.
+        self.es = Elasticsearch(
+            [{'host': host, 'port': port, 'scheme': 'http'}],
+            **_client_kwargs(max(self.thread_count, 10))
+        )
         self.create_index()
 
     def create_index(self):
         """
-        Create the Elasticsearch index with mappings.
+        Create the Elasticsearch index with mappings, if it does not exist.
         """
-        mapping = {
-            "mappings": {
-                "properties": {
-                    "doc_id": {"type": "keyword"},
-                    "text": {"type": "text"},
-                    "cluster": {"type": "keyword"}
-                }
-            }
-        }
-        if not self.es.indices.exists(index=self.index_name):
-            self.es.indices.create(index=self.index_name, body=mapping)
+        if self._index_key in _KNOWN_INDICES:
+            return
+        try:
+            self.es.indices.create(index=self.index_name, body=INDEX_MAPPING)
+        except BadRequestError as err:
+            if not _is_index_exists_error(err):
+                raise
+        _KNOWN_INDICES.add(self._index_key)
 
     def add_document(self, doc_id, text, cluster='root'):
         """
@@ -60,29 +221,92 @@ class FractalElasticsearchEngine:
             "cluster": cluster
         }
         self.es.index(index=self.index_name, id=doc_id, body=doc)
+        self._mark_write()
 
-    def bulk_add_documents(self, docs):
+    def bulk_add_documents(self, docs, chunk_size=None, max_chunk_bytes=None,
+                           thread_count=None):
         """
-        Bulk index documents.
+        Bulk index documents using parallel bulk requests.
+
+        At most thread_count requests are in flight at once, so only a few
+        chunks of the documents are held in memory at any time. Failed
+        documents are logged as soon as their chunk completes.
 
         Parameters:
-            docs (list): List of dictionaries with keys 'doc_id', 'text',
-                         and optionally 'cluster'.
-        """
-        actions = []
-        for doc in docs:
-            action = {
-                "_index": self.index_name,
-                "_id": doc['doc_id'],
-                "_source": doc
-            }
-            actions.append(action)
-        helpers.bulk(self.es, actions)
+            docs (iterable): Dictionaries with keys 'doc_id', 'text',
+                             and optionally 'cluster'.
+            chunk_size (int): Overrides the engine's chunk_size.
+            max_chunk_bytes (int): Overrides the engine's max_chunk_bytes.
+            thread_count (int): Overrides the engine's thread_count. With 1,
+                                requests are sent from the calling thread.
+
+        Returns:
+            tuple: Number of indexed documents and number of failed documents.
+        """
+        bodies = _bulk_bodies(
+            docs,
+            chunk_size or self.chunk_size,
+            max_chunk_bytes or self.max_chunk_bytes,
+        )
+        indexed = failed = 0
+        try:
+            responses = self._send_bulks(
+                bodies, thread_count or self.thread_count
+            )
+            for response in responses:
+                ok, errors = _bulk_results(response)
+                indexed += ok
+                failed += errors
+        finally:
+            # Earlier chunks may have been indexed even if a later one raised.
+            self._mark_write()
+        return indexed, failed
+
+    def _mark_write(self):
+        """
+        Invalidate cached searches after a write.
+        """
+        with self._write_lock:
+            self._version += 1
+            self._last_write = time.monotonic()
+
+    def _send_bulks(self, bodies, thread_count):
+        """
+        Send bulk request bodies, yielding the responses in order.
+
+        A single thread sends the bodies inline rather than through a thread
+        pool, which keeps working once the interpreter starts shutting down
+        and concurrent.futures refuses new work.
+        """
+        if thread_count == 1:
+            for body in bodies:
+                yield self._send_bulk(body)
+            return
+        with ThreadPoolExecutor(max_workers=thread_count) as pool:
+            pending = deque()
+            for body in bodies:
+                if len(pending) >= thread_count:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(self._send_bulk, body))
+            while pending:
+                yield pending.popleft().result()
+
+    def _send_bulk(self, body):
+        """
+        Send a pre-encoded NDJSON bulk request body.
+        """
+        return self.es.bulk(index=self.index_name, operations=body)
 
     def search(self, query, cluster_filter=None):
         """
         Search for documents matching the query. Optionally filter by cluster.
 
+        Responses are served from an LRU cache until a document is written
+        through this engine or search_cache_ttl elapses. Until
+        refresh_interval has passed after a write, Elasticsearch may not
+        return the new documents yet, so searches bypass the cache. Cached
+        responses are shared between callers and must not be modified.
+
         Parameters:
             query (str): The search query.
             cluster_filter (str): Optional cluster filter.
@@ -90,19 +314,153 @@ class FractalElasticsearchEngine:
         Returns:
             dict: Elasticsearch search results.
         """
-        query_body = {
-            "query": {
-                "bool": {
-                    "must": {
-                        "match": {
-                            "text": query
-                        }
-                    }
-                }
-            }
-        }
-        if cluster_filter:
-            query_body["query"]["bool"]["filter"] = {
-                "term": {"cluster": cluster_filter}
-            }
-        return self.es.search(index=self.index_name, body=query_body)
+        now = time.monotonic()
+        if (self._last_write is not None
+                and now - self._last_write < self.refresh_interval):
+            return self._search(query, cluster_filter)
+        ttl_bucket = 0
+        if self.search_cache_ttl:
+            ttl_bucket = int(now // self.search_cache_ttl)
+        return self._cached_search(
+            query, cluster_filter, self._version, ttl_bucket
+        )
+
+    def _search(self, query, cluster_filter, *cache_key):
+        """
+        Run a search against Elasticsearch. The cache_key arguments (write
+        version and TTL bucket) only take part in the cache key.
+        """
+        return self.es.search(
+            index=self.index_name, body=_query_body(query, cluster_filter)
+        )
+
+
+class BufferedIndexer:
+    """
+    Coalesce single-document writes into bulk requests.
+
+    Documents are queued and indexed by a background thread, which flushes
+    them through the engine's bulk_add_documents once chunk_size documents
+    are buffered or flush_interval seconds have passed since the first one.
+    A flush that raises (e.g. Elasticsearch is unreachable) is retried with
+    exponential backoff; a batch still failing after max_retries is logged
+    and dropped, so delivery is best-effort. At most max_queue_size
+    documents are buffered; beyond that add_document raises queue.Full.
+    Buffered documents are flushed on close and at interpreter exit. Flushes
+    are sent from the background thread itself, without a thread pool, so
+    that they still work while the interpreter shuts down.
+    """
+
+    _STOP = object()
+
+    def __init__(self, engine, chunk_size=500, flush_interval=1.0,
+                 max_retries=3, retry_backoff=0.5, max_queue_size=10000):
+        """
+        Start the background flushing thread.
+
+        Parameters:
+            engine (FractalElasticsearchEngine): Engine used for indexing.
+            chunk_size (int): Maximum number of documents per flush.
+            flush_interval (float): Maximum seconds a document stays buffered.
+            max_retries (int): Number of times a failed flush is retried.
+            retry_backoff (float): Seconds before the first retry, doubled
+                                   for each following one.
+            max_queue_size (int): Maximum number of buffered documents.
+        """
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add_document(self, doc_id, text, cluster='root'):
+        """
+        Queue a single document for indexing.
+
+        Parameters:
+            doc_id (str): Document identifier.
+            text (str): Document text.
+            cluster (str): Cluster label for fractal grouping.
+
+        Raises:
+            queue.Full: If max_queue_size documents are already buffered.
+        """
+        if self._closed:
+            raise RuntimeError('BufferedIndexer is closed.')
+        self._queue.put_nowait({
+            "doc_id": doc_id,
+            "text": text,
+            "cluster": cluster
+        })
+
+    def close(self):
+        """
+        Flush the buffered documents and stop the background thread.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        """
+        Drain the queue into batches and index them until stopped.
+        """
+        stopped = False
+        while not stopped:
+            batch, stopped = self._next_batch()
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        """
+        Index a batch, retrying with exponential backoff if it raises.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.engine.bulk_add_documents(batch, thread_count=1)
+                return
+            except Exception:
+                if attempt == self.max_retries:
+                    logger.exception(
+                        "Dropping %d buffered documents after %d attempts",
+                        len(batch), attempt + 1
+                    )
+                    return
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning(
+                    "Failed to index %d buffered documents, retrying in %.1fs",
+                    len(batch), delay, exc_info=True
+                )
+                time.sleep(delay)
+
+    def _next_batch(self):
+        """
+        Wait for the next batch of documents.
+
+        Returns:
+            tuple: The batch and whether the indexer was stopped.
+        """
+        item = self._queue.get()
+        if item is self._STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.chunk_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
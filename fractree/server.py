@@ -4,19 +4,28 @@ Flask server for the Fractal Elasticsearch Search Engine.
 This server exposes endpoints to index documents and perform searches.
 """
 
+import queue
+
 from flask import Flask, request, jsonify
-from elastic_engine import FractalElasticsearchEngine
+from elastic_engine import BufferedIndexer, FractalElasticsearchEngine
 
 app = Flask(__name__)
 
 # Create an instance of the search engine.
 engine = FractalElasticsearchEngine(index_name='fractal_search')
 
+# Batch single-document writes into bulk requests in the background.
+indexer = BufferedIndexer(engine)
+
 @app.route('/index', methods=['POST'])
 def index_document():
     """
     Endpoint to index a single document.
     Expects JSON with 'doc_id', 'text', and optionally 'cluster'.
+    The document is queued and indexed with the next bulk flush. Delivery is
+    best-effort: the 202 reply does not guarantee the document is indexed,
+    since a batch is dropped if Elasticsearch stays unreachable through all
+    retries. Responds with 503 when the indexing queue is full.
     """
     data = request.get_json()
     doc_id = data.get('doc_id')
@@ -26,8 +35,11 @@ def index_document():
     if not doc_id or not text:
         return jsonify({'error': 'doc_id and text are required.'}), 400
 
-    engine.add_document(doc_id, text, cluster)
-    return jsonify({'message': 'Document indexed successfully.'}), 201
+    try:
+        indexer.add_document(doc_id, text, cluster)
+    except queue.Full:
+        return jsonify({'error': 'Indexing queue is full, retry later.'}), 503
+    return jsonify({'message': 'Document queued for indexing.'}), 202
 
 
 @app.route('/bulk_index', methods=['POST'])
@@ -36,14 +48,26 @@ def bulk_index():
     Endpoint to bulk index documents.
     Expects a JSON array of documents.
     Each document should have 'doc_id', 'text', and optionally 'cluster'.
+    Responds with 207 if some documents were rejected, and 400 if all were.
     """
     data = request.get_json()
 
     if not isinstance(data, list):
         return jsonify({'error': 'Expected a list of documents.'}), 400
 
-    engine.bulk_add_documents(data)
-    return jsonify({'message': 'Documents indexed successfully.'}), 201
+    indexed, failed = engine.bulk_add_documents(data)
+    if failed:
+        status = 207 if indexed else 400
+        return jsonify({
+            'error': f'{failed} documents failed to index.',
+            'indexed': indexed,
+            'failed': failed
+        }), status
+    return jsonify({
+        'message': 'Documents indexed successfully.',
+        'indexed': indexed,
+        'failed': failed
+    }), 201
 
 
 @app.route('/search', methods=['GET'])
@@ -73,7 +97,13 @@ def search():
         }
         for hit in hits
     ]
-    return jsonify({'results': docs})
+    response = jsonify({'results': docs})
+    # Proxies never see writes, so only let them reuse results for the index
+    # refresh interval, which search results already lag writes by.
+    response.headers['Cache-Control'] = (
+        f'public, max-age={int(engine.refresh_interval)}'
+    )
+    return response
 
 
 if __name__ == '__main__':
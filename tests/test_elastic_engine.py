@@ -1,21 +1,115 @@
+import json
+import os
+import queue
+import subprocess
+import sys
+import textwrap
+import threading
+import time
 import unittest
 from unittest.mock import MagicMock, patch
-from fractree.elastic_engine import FractalElasticsearchEngine
+from elastic_transport import ApiResponseMeta
+from elasticsearch import BadRequestError
+from fractree import elastic_engine
+from fractree.elastic_engine import (
+    BufferedIndexer,
+    FractalElasticsearchEngine,
+    OrjsonSerializer,
+)
+
+
+def bad_request(error_type):
+    """
+    Build a BadRequestError as raised by the client for the given error type.
+    """
+    meta = ApiResponseMeta(
+        status=400, http_version='1.1', headers={}, duration=0.0, node=None
+    )
+    return BadRequestError(error_type, meta, {'error': {'type': error_type}})
+
 
 class TestFractalElasticsearchEngine(unittest.TestCase):
+    def setUp(self):
+        elastic_engine._KNOWN_INDICES.clear()
+
     @patch('fractree.elastic_engine.Elasticsearch')
     def test_create_index(self, mock_elasticsearch):
         """
         Test that the index is created if it does not exist.
         """
-        # Setup the mock for indices.exists to return False
         es_instance = MagicMock()
-        es_instance.indices.exists.return_value = False
         mock_elasticsearch.return_value = es_instance
 
         # Initialize engine which should trigger index creation.
         engine = FractalElasticsearchEngine(index_name='test_index')
         es_instance.indices.create.assert_called_once()
+        es_instance.indices.exists.assert_not_called()
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_create_index_is_cached(self, mock_elasticsearch):
+        """
+        Test that a known index is not created again by later engines.
+        """
+        es_instance = MagicMock()
+        mock_elasticsearch.return_value = es_instance
+
+        FractalElasticsearchEngine(index_name='test_index')
+        FractalElasticsearchEngine(index_name='test_index')
+        es_instance.indices.create.assert_called_once()
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_create_index_already_exists(self, mock_elasticsearch):
+        """
+        Test that an already existing index is not an error.
+        """
+        es_instance = MagicMock()
+        es_instance.indices.create.side_effect = bad_request(
+            'resource_already_exists_exception'
+        )
+        mock_elasticsearch.return_value = es_instance
+
+        FractalElasticsearchEngine(index_name='test_index')
+        self.assertIn(
+            ('localhost', 9200, 'test_index'), elastic_engine._KNOWN_INDICES
+        )
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_create_index_error(self, mock_elasticsearch):
+        """
+        Test that other index creation errors are raised.
+        """
+        es_instance = MagicMock()
+        es_instance.indices.create.side_effect = bad_request(
+            'illegal_argument_exception'
+        )
+        mock_elasticsearch.return_value = es_instance
+
+        with self.assertRaises(BadRequestError):
+            FractalElasticsearchEngine(index_name='test_index')
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_client_options(self, mock_elasticsearch):
+        """
+        Test that the client compresses requests and pools a connection
+        per bulk thread.
+        """
+        mock_elasticsearch.return_value = MagicMock()
+
+        FractalElasticsearchEngine(index_name='test_index', thread_count=16)
+        kwargs = mock_elasticsearch.call_args.kwargs
+        self.assertTrue(kwargs['http_compress'])
+        self.assertEqual(kwargs['connections_per_node'], 16)
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_orjson_serializer(self, mock_elasticsearch):
+        """
+        Test that the client is configured with the orjson serializer.
+        """
+        mock_elasticsearch.return_value = MagicMock()
+
+        FractalElasticsearchEngine(index_name='test_index')
+        serializer = mock_elasticsearch.call_args.kwargs['serializer']
+        self.assertIsInstance(serializer, OrjsonSerializer)
 
     @patch('fractree.elastic_engine.Elasticsearch')
     def test_add_document(self, mock_elasticsearch):
@@ -37,13 +131,13 @@ class TestFractalElasticsearchEngine(unittest.TestCase):
             index='test_index', id='doc1', body=expected_doc
         )
 
-    @patch('fractree.elastic_engine.helpers.bulk')
     @patch('fractree.elastic_engine.Elasticsearch')
-    def test_bulk_add_documents(self, mock_elasticsearch, mock_bulk):
+    def test_bulk_add_documents(self, mock_elasticsearch):
         """
         Test bulk adding documents.
         """
         es_instance = MagicMock()
+        es_instance.bulk.return_value = {'errors': False, 'items': []}
         mock_elasticsearch.return_value = es_instance
 
         engine = FractalElasticsearchEngine(index_name='test_index')
@@ -53,8 +147,71 @@ class TestFractalElasticsearchEngine(unittest.TestCase):
         ]
         engine.bulk_add_documents(docs)
 
-        # Verify that the helpers.bulk method was called once.
-        mock_bulk.assert_called_once()
+        # Both documents fit in a single pre-encoded NDJSON request.
+        es_instance.bulk.assert_called_once()
+        kwargs = es_instance.bulk.call_args.kwargs
+        self.assertEqual(kwargs['index'], 'test_index')
+        lines = [json.loads(line)
+                 for line in kwargs['operations'].splitlines()]
+        self.assertEqual(lines, [
+            {'index': {'_id': 'doc1'}}, docs[0],
+            {'index': {'_id': 'doc2'}}, docs[1],
+        ])
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_bulk_add_documents_chunks(self, mock_elasticsearch):
+        """
+        Test that bulk requests are split by chunk size and byte size.
+        """
+        es_instance = MagicMock()
+        es_instance.bulk.return_value = {'errors': False, 'items': []}
+        mock_elasticsearch.return_value = es_instance
+        docs = [{'doc_id': f'doc{i}', 'text': 'Document', 'cluster': 'c'}
+                for i in range(5)]
+
+        engine = FractalElasticsearchEngine(
+            index_name='test_index', thread_count=2, chunk_size=2
+        )
+        engine.bulk_add_documents(iter(docs))
+        self.assertEqual(es_instance.bulk.call_count, 3)
+
+        es_instance.bulk.reset_mock()
+        engine.bulk_add_documents(docs, chunk_size=4)
+        self.assertEqual(es_instance.bulk.call_count, 2)
+
+        es_instance.bulk.reset_mock()
+        engine = FractalElasticsearchEngine(
+            index_name='test_index', max_chunk_bytes=1
+        )
+        engine.bulk_add_documents(docs)
+        self.assertEqual(es_instance.bulk.call_count, 5)
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_bulk_add_documents_logs_errors(self, mock_elasticsearch):
+        """
+        Test that documents rejected by Elasticsearch are logged.
+        """
+        es_instance = MagicMock()
+        es_instance.bulk.return_value = {
+            'errors': True,
+            'items': [
+                {'index': {'_id': 'doc1', 'status': 201}},
+                {'index': {'_id': 'doc2', 'status': 400,
+                           'error': {'type': 'mapper_parsing_exception'}}},
+            ]
+        }
+        mock_elasticsearch.return_value = es_instance
+
+        engine = FractalElasticsearchEngine(index_name='test_index')
+        docs = [
+            {'doc_id': 'doc1', 'text': 'Document 1'},
+            {'doc_id': 'doc2', 'text': 'Document 2'},
+        ]
+        with self.assertLogs('fractree.elastic_engine', 'ERROR') as logs:
+            result = engine.bulk_add_documents(docs)
+        self.assertEqual(result, (1, 1))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('doc2', logs.output[0])
 
     @patch('fractree.elastic_engine.Elasticsearch')
     def test_search_without_cluster_filter(self, mock_elasticsearch):
@@ -123,6 +280,293 @@ class TestFractalElasticsearchEngine(unittest.TestCase):
             'filtered_cluster'
         )
 
+        # The pre-rendered body must be valid JSON with the filter spliced in.
+        body = json.loads(es_instance.search.call_args.kwargs['body'])
+        self.assertEqual(body, {
+            'query': {
+                'bool': {
+                    'must': {'match': {'text': 'Test'}},
+                    'filter': {'term': {'cluster': 'filtered_cluster'}}
+                }
+            }
+        })
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_search_body_escapes_query(self, mock_elasticsearch):
+        """
+        Test that quotes in the query are escaped in the rendered body.
+        """
+        es_instance = MagicMock()
+        mock_elasticsearch.return_value = es_instance
+
+        engine = FractalElasticsearchEngine(index_name='test_index')
+        engine.search('say "hi"')
+
+        body = json.loads(es_instance.search.call_args.kwargs['body'])
+        self.assertEqual(body, {
+            'query': {'bool': {'must': {'match': {'text': 'say "hi"'}}}}
+        })
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_search_is_cached(self, mock_elasticsearch):
+        """
+        Test that repeated searches are served from the cache.
+        """
+        es_instance = MagicMock()
+        es_instance.search.return_value = {'hits': {'hits': []}}
+        mock_elasticsearch.return_value = es_instance
+
+        engine = FractalElasticsearchEngine(index_name='test_index')
+        engine.search('Test')
+        engine.search('Test')
+        self.assertEqual(es_instance.search.call_count, 1)
+
+        engine.search('Test', cluster_filter='filtered_cluster')
+        self.assertEqual(es_instance.search.call_count, 2)
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_search_cache_invalidated_on_write(self, mock_elasticsearch):
+        """
+        Test that indexing a document invalidates cached searches.
+        """
+        es_instance = MagicMock()
+        es_instance.search.return_value = {'hits': {'hits': []}}
+        mock_elasticsearch.return_value = es_instance
+
+        engine = FractalElasticsearchEngine(index_name='test_index')
+        engine.search('Test')
+        engine.add_document('doc1', 'Test document')
+        engine.search('Test')
+        self.assertEqual(es_instance.search.call_count, 2)
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_search_cache_disabled(self, mock_elasticsearch):
+        """
+        Test that a zero cache size always queries Elasticsearch.
+        """
+        es_instance = MagicMock()
+        es_instance.search.return_value = {'hits': {'hits': []}}
+        mock_elasticsearch.return_value = es_instance
+
+        engine = FractalElasticsearchEngine(
+            index_name='test_index', search_cache_size=0
+        )
+        engine.search('Test')
+        engine.search('Test')
+        self.assertEqual(es_instance.search.call_count, 2)
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_search_cache_invalidated_on_failed_bulk(self,
+                                                     mock_elasticsearch):
+        """
+        Test that a bulk write failing after some chunks were indexed still
+        invalidates cached searches.
+        """
+        es_instance = MagicMock()
+        es_instance.search.return_value = {'hits': {'hits': []}}
+        es_instance.bulk.side_effect = [
+            {'errors': False, 'items': [{'index': {'_id': 'doc1'}}]},
+            ConnectionError(),
+        ]
+        mock_elasticsearch.return_value = es_instance
+
+        engine = FractalElasticsearchEngine(
+            index_name='test_index', thread_count=1, chunk_size=1,
+            refresh_interval=0
+        )
+        engine.search('Test')
+        docs = [{'doc_id': 'doc1', 'text': 'Document 1'},
+                {'doc_id': 'doc2', 'text': 'Document 2'}]
+        with self.assertRaises(ConnectionError):
+            engine.bulk_add_documents(docs)
+        engine.search('Test')
+        self.assertEqual(es_instance.search.call_count, 2)
+
+    @patch('fractree.elastic_engine.time.monotonic')
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_search_not_cached_before_refresh(self, mock_elasticsearch,
+                                              mock_monotonic):
+        """
+        Test that searches between a write and the index refresh are not
+        cached, so results missing the new document are not reused.
+        """
+        es_instance = MagicMock()
+        stale = {'hits': {'hits': []}}
+        fresh = {'hits': {'hits': [{'_source': {'doc_id': 'doc1'}}]}}
+        es_instance.search.side_effect = [stale, fresh, fresh]
+        mock_elasticsearch.return_value = es_instance
+        mock_monotonic.return_value = 100.0
+
+        engine = FractalElasticsearchEngine(
+            index_name='test_index', refresh_interval=1.0
+        )
+        engine.add_document('doc1', 'Test document')
+
+        # Before the refresh, Elasticsearch still misses the new document.
+        mock_monotonic.return_value = 100.5
+        self.assertIs(engine.search('Test'), stale)
+
+        # After the refresh, the fresh response is fetched and cached.
+        mock_monotonic.return_value = 101.5
+        self.assertIs(engine.search('Test'), fresh)
+        self.assertIs(engine.search('Test'), fresh)
+        self.assertEqual(es_instance.search.call_count, 2)
+
+    @patch('fractree.elastic_engine.Elasticsearch')
+    def test_search_cache_without_ttl(self, mock_elasticsearch):
+        """
+        Test that a zero or missing TTL disables expiry instead of failing.
+        """
+        es_instance = MagicMock()
+        es_instance.search.return_value = {'hits': {'hits': []}}
+        mock_elasticsearch.return_value = es_instance
+
+        for ttl in (0, None):
+            es_instance.search.reset_mock()
+            engine = FractalElasticsearchEngine(
+                index_name='test_index', search_cache_ttl=ttl
+            )
+            engine.search('Test')
+            engine.search('Test')
+            self.assertEqual(es_instance.search.call_count, 1)
+
+
+class TestBufferedIndexer(unittest.TestCase):
+    def test_close_flushes_documents(self):
+        """
+        Test that buffered documents are bulk indexed on close.
+        """
+        engine = MagicMock()
+        indexer = BufferedIndexer(engine, flush_interval=60)
+        indexer.add_document('doc1', 'Document 1', cluster='cluster1')
+        indexer.add_document('doc2', 'Document 2')
+        indexer.close()
+
+        engine.bulk_add_documents.assert_called_once_with([
+            {'doc_id': 'doc1', 'text': 'Document 1', 'cluster': 'cluster1'},
+            {'doc_id': 'doc2', 'text': 'Document 2', 'cluster': 'root'},
+        ], thread_count=1)
+        with self.assertRaises(RuntimeError):
+            indexer.add_document('doc3', 'Document 3')
+
+    def test_flush_by_chunk_size(self):
+        """
+        Test that documents are flushed in batches of chunk_size.
+        """
+        engine = MagicMock()
+        indexer = BufferedIndexer(engine, chunk_size=2, flush_interval=60)
+        for i in range(5):
+            indexer.add_document(f'doc{i}', 'Document')
+        indexer.close()
+
+        batch_sizes = [len(call.args[0])
+                       for call in engine.bulk_add_documents.call_args_list]
+        self.assertEqual(batch_sizes, [2, 2, 1])
+
+    def test_flush_by_interval(self):
+        """
+        Test that documents are flushed once the interval elapses.
+        """
+        engine = MagicMock()
+        flushed = threading.Event()
+        engine.bulk_add_documents.side_effect = (
+            lambda docs, **kwargs: flushed.set()
+        )
+        indexer = BufferedIndexer(engine, flush_interval=0.01)
+        indexer.add_document('doc1', 'Document 1')
+
+        self.assertTrue(flushed.wait(timeout=5))
+        indexer.close()
+
+    def test_queue_full(self):
+        """
+        Test that documents beyond max_queue_size are refused.
+        """
+        engine = MagicMock()
+        release = threading.Event()
+        engine.bulk_add_documents.side_effect = (
+            lambda docs, **kwargs: release.wait(timeout=5)
+        )
+        indexer = BufferedIndexer(
+            engine, chunk_size=1, flush_interval=0, max_queue_size=1
+        )
+        # The first document is taken by the flusher, which then blocks;
+        # the second fills the queue.
+        indexer.add_document('doc1', 'Document 1')
+        deadline = time.monotonic() + 5
+        while (not engine.bulk_add_documents.called
+               and time.monotonic() < deadline):
+            time.sleep(0.01)
+        indexer.add_document('doc2', 'Document 2')
+
+        with self.assertRaises(queue.Full):
+            indexer.add_document('doc3', 'Document 3')
+        release.set()
+        indexer.close()
+        self.assertEqual(engine.bulk_add_documents.call_count, 2)
+
+    def test_flush_at_interpreter_exit(self):
+        """
+        Test that documents still buffered at exit are indexed with the
+        real engine, after concurrent.futures has stopped accepting work.
+        """
+        script = textwrap.dedent('''
+            import atexit
+            from unittest.mock import MagicMock, patch
+
+            from fractree.elastic_engine import (
+                BufferedIndexer,
+                FractalElasticsearchEngine,
+            )
+
+            es = MagicMock()
+            es.bulk.return_value = {'errors': False, 'items': []}
+            # Registered first, so it runs after the indexer's close.
+            atexit.register(lambda: print('bulk calls:', es.bulk.call_count))
+            with patch('fractree.elastic_engine.Elasticsearch',
+                       return_value=es):
+                engine = FractalElasticsearchEngine(
+                    index_name='test_index', thread_count=4
+                )
+            indexer = BufferedIndexer(engine, flush_interval=60)
+            indexer.add_document('doc1', 'Document 1')
+        ''')
+        result = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('bulk calls: 1', result.stdout)
+        self.assertNotIn('Failed to index', result.stderr)
+
+    def test_flush_retries_on_error(self):
+        """
+        Test that a failed flush is retried before giving up.
+        """
+        engine = MagicMock()
+        engine.bulk_add_documents.side_effect = [ConnectionError(), None]
+        indexer = BufferedIndexer(engine, retry_backoff=0)
+        indexer.add_document('doc1', 'Document 1')
+        with self.assertLogs('fractree.elastic_engine', 'WARNING'):
+            indexer.close()
+
+        self.assertEqual(engine.bulk_add_documents.call_count, 2)
+
+    def test_flush_gives_up_after_max_retries(self):
+        """
+        Test that a batch is dropped and logged once retries run out.
+        """
+        engine = MagicMock()
+        engine.bulk_add_documents.side_effect = ConnectionError()
+        indexer = BufferedIndexer(engine, max_retries=2, retry_backoff=0)
+        indexer.add_document('doc1', 'Document 1')
+        with self.assertLogs('fractree.elastic_engine', 'ERROR') as logs:
+            indexer.close()
+
+        self.assertEqual(engine.bulk_add_documents.call_count, 3)
+        self.assertIn('Dropping 1 buffered documents', logs.output[-1])
+
 
 if __name__ == '__main__':
     unittest.main()